@@ -1,6 +1,6 @@
 import argparse
 import torch
-from read_data import Dataset
+from read_data import Dataset, CUDAPrefetcher
 from model import MTLArchitecture
 from utils import get_init_weights
 import copy
@@ -20,8 +20,16 @@ def main(args):
     logger = Logger(args.model + '.log', True)
 
     device = torch.device('cuda' if args.cuda else 'cpu')
+    if args.cuda:
+        # The RNN sizes are fixed, so let cuDNN pick and cache the fastest algorithm for every input shape it
+        # sees, and allow TF32 matmuls on Ampere and newer GPUs (the setting only exists from PyTorch 1.7).
+        torch.backends.cudnn.benchmark = True
+        if hasattr(torch.backends.cuda, 'matmul'):
+            torch.backends.cuda.matmul.allow_tf32 = True
 
-    data = Dataset(path, args.dataset_name, 2, device)
+    # On GPU, batches stay in pinned memory and are copied over asynchronously while the previous batch runs.
+    data = Dataset(path, args.dataset_name, 2, device, pin_memory=args.cuda)
+    prefetch = (lambda batches: CUDAPrefetcher(batches, device)) if args.cuda else (lambda batches: batches)
 
     data.log(logger)
     logger.log(str(args))
@@ -31,24 +39,29 @@ def main(args):
                             args.num_layers_ner, args.num_layers_re, len(data.tag2y), \
                             len(data.relation2y), args.init, args.label_embeddings_size, \
                             args.re_f1_size, args.re_lambda, args.e1_activation_type, \
-                            args.r1_activation_type, args.recurrent_unit, device).to(device)
+                            args.r1_activation_type, args.recurrent_unit, device, args.compile, \
+                            elmo_cache=args.elmo_cache, glove_storage=args.glove_storage).to(device)
 
     model.apply(get_init_weights(args.init))
-    optim = torch.optim.Adam(model.parameters(), lr=args.lr)
     best_model = copy.deepcopy(model)
+    if args.compile:
+        model.warmup(next(iter(prefetch(data.batches_train))), bf16=args.bf16)
+    optim = torch.optim.Adam(model.parameters(), lr=args.lr)
     best_perf = float('-inf')
     bad_epochs = 0
 
     try:
         for ep in range(1, args.epochs + 1):
             random.shuffle(data.batches_train)
-            output = model.do_epoch(ep, data.batches_train, args.clip, optim, logger=logger, check_interval=args.check_interval)
+            output = model.do_epoch(ep, prefetch(data.batches_train), args.clip, optim, logger=logger, check_interval=args.check_interval,
+                                    bf16=args.bf16)
 
             if math.isnan(output['loss']):
                 break
 
             with torch.no_grad():
-                    eval_result = model.evaluate(data.batches_test, logger=logger, tag2y=data.tag2y, rel2y=data.relation2y)
+                    eval_result = model.evaluate(prefetch(data.batches_test), logger=logger, tag2y=data.tag2y, rel2y=data.relation2y,
+                                                 bf16=args.bf16)
                     print(eval_result)
                 
             # perf = eval_result['f1_<all>'] + eval_result['re_f1']
@@ -171,6 +184,12 @@ if __name__ == "__main__":
     parser.add_argument('--e1_activation_type', default='tanh', help='activation for NER FF1 [%(default)g]')
     parser.add_argument('--r1_activation_type', default='relu', help='activation for RE FF1 [%(default)g]')
     parser.add_argument('--recurrent_unit', default='gru')
+    parser.add_argument('--elmo_cache', default=None,
+                        help='directory of ELMO embeddings precomputed with scripts/precompute_elmo.py')
+    parser.add_argument('--glove_storage', default='fp32', choices=['fp32', 'int8', 'bf16'],
+                        help='storage of the Glove table, int8 and bf16 keep it on device [%(default)s]')
+    parser.add_argument('--bf16', action='store_true', help='run forward passes under bfloat16 autocast?')
+    parser.add_argument('--compile', action='store_true', help='use torch.compile on the model layers?')
     parser.add_argument('--init', type=float, default=0.01, help='uniform init range [%(default)g]')
     parser.add_argument('--lr', type=float, default=0.0005, help='initial learning rate [%(default)g]')
     parser.add_argument('--epochs', type=int, default=10, help='max number of epochs [%(default)d]')
@@ -182,4 +201,6 @@ if __name__ == "__main__":
     parser.add_argument('--re_f1_size', type=int, default=128)
     parser.add_argument('--seed', type=int, default=42, help='random seed [%(default)d]')
     args = parser.parse_args()
+    if args.bf16 and not hasattr(torch, 'autocast'):
+        parser.error('--bf16 needs PyTorch 1.10+, found {}'.format(torch.__version__))
     main(args)
\ No newline at end of file
@@ -1,13 +1,57 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn.utils.rnn import pack_padded_sequence
-from utils import load_glove_embeddings, load_elmo_embeddings, load_onehot_embeddings, get_boundaries
+from utils import load_glove_embeddings, load_elmo_embeddings, load_cached_elmo_embeddings, load_onehot_embeddings, \
+                  get_boundaries
 from crf import CRFLoss
 import math
 import itertools
+import contextlib
 from collections import defaultdict, Counter
 import numpy as np
 
+# Activation functions available for the first feed-forward layer of the NER and RE heads.
+ACTIVATIONS = {"relu": nn.ReLU, "tanh": nn.Tanh, "gelu": nn.GELU}
+
+def bf16_autocast(device_type, enabled):
+    """
+    Returns a bfloat16 autocast context if enabled, and a no-op context otherwise so that runs without bf16 still
+    work on PyTorch versions that predate torch.autocast.
+
+    :param device_type: the device type the forward pass runs on
+    :param enabled: whether to autocast
+    :return:
+    """
+
+    if enabled:
+        if not hasattr(torch, "autocast"):
+            raise RuntimeError("bfloat16 autocast needs PyTorch 1.10+, found {}".format(torch.__version__))
+        return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+def autocast_disabled(device_type):
+    """
+    Returns a context that runs its body outside of autocast, a no-op on PyTorch versions without torch.autocast.
+
+    :param device_type: the device type the ops run on
+    :return:
+    """
+
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device_type=device_type, enabled=False)
+    return contextlib.nullcontext()
+
+def is_compiling():
+    """
+    Returns whether the code is being traced by torch.compile, False on PyTorch versions without it.
+
+    :return:
+    """
+
+    compiler = getattr(torch, "compiler", None)
+    return compiler is not None and hasattr(compiler, "is_compiling") and compiler.is_compiling()
+
 class MTLArchitecture(nn.Module):
     """
     The main class where all successive architectures are initialised and a forward pass is done through each
@@ -17,7 +61,8 @@ class MTLArchitecture(nn.Module):
     def __init__(self, num_word_types, shared_layer_size, num_char_types,
                  char_dim, hidden_dim, dropout, re_dropout, num_layers_shared, num_layers_ner, 
                  num_layers_re, num_tag_types, num_rel_types, init, label_embeddings_size, re_ff1_size,
-                 re_lambda, e1_activation_type, r1_activation_type, recurrent_unit="gru", device='cuda'):
+                 re_lambda, e1_activation_type, r1_activation_type, recurrent_unit="gru", device='cuda',
+                 compile=False, elmo_cache=None, glove_storage="fp32"):
         """
         Initialise.
 
@@ -36,33 +81,75 @@ class MTLArchitecture(nn.Module):
         :param label_embeddings_size: label embedding size to be used in NER and RE
         :param activation_type: the type of activation function to use
         :param recurrent_unit: the type of recurrent unit to use for biRNN - GRU or LSTM
+        :param compile: compile the forward of the shared, NER and RE layers in place with torch.compile (needs
+                        PyTorch 2.2+, skipped on MPS). Only the training forward pass is compiled, the scorer
+                        methods used by evaluate run eagerly.
+        :param elmo_cache: directory of ELMO embeddings precomputed by scripts/precompute_elmo.py, if any
+        :param glove_storage: storage of the Glove table - fp32, int8 (quantized, kept on device) or bf16 (kept on device)
         """
 
         super(MTLArchitecture, self).__init__()
 
         self.RELossLambda = re_lambda
+
+        # Activations are stateless, so the NER and RE heads share a single instance per activation type. They
+        # are scripted here, once, because the heads script their feed-forward layers and would otherwise each
+        # script their own copy of the activation.
+        activations = {act: torch.jit.script(ACTIVATIONS[act]()) for act in {e1_activation_type, r1_activation_type}}
+
         self.shared_layers = SharedRNN(num_word_types, shared_layer_size, num_char_types,
                                        char_dim, hidden_dim, dropout, num_layers_shared,
-                                       recurrent_unit, device)
+                                       recurrent_unit, device, elmo_cache, glove_storage)
 
         self.ner_layers = NERSpecificRNN(shared_layer_size, num_tag_types, hidden_dim, dropout,
                                          num_layers_ner, init, label_embeddings_size,
-                                         e1_activation_type, recurrent_unit)
+                                         e1_activation_type, recurrent_unit,
+                                         activation=activations[e1_activation_type])
 
         self.re_layers = RESpecificRNN(shared_layer_size, num_rel_types, hidden_dim, dropout, re_dropout,
                                        num_layers_re, label_embeddings_size, re_ff1_size,
-                                       r1_activation_type, recurrent_unit, device)
+                                       r1_activation_type, recurrent_unit, device,
+                                       activation=activations[r1_activation_type])
 
-        self.loss = nn.CrossEntropyLoss()
+        self.compiled = compile and hasattr(nn.Module, "compile") and not torch.backends.mps.is_available()
+        if self.compiled:
+            # Compile in place so the state_dict keys, and so the saved checkpoints, are the same as without
+            # compiling. Sentence and word lengths vary from batch to batch, so compile with dynamic shapes to
+            # avoid recompiling for every new length.
+            for layers in (self.shared_layers, self.ner_layers, self.re_layers):
+                layers.compile(mode="reduce-overhead", dynamic=True, fullgraph=False)
+
+    def warmup(self, batch, bf16=False, num_iters=3):
+        """
+        Run a few forward and backward passes on a single batch so that the compilation cost of the compiled
+        layers is paid once before training starts. Gradients are cleared afterwards. Does nothing if the layers
+        were not compiled.
 
-    def score(self, X, Y, C, C_lengths, rstartseqs, rendseqs, rseqs, sents):
+        :param batch: a training batch, in the same format as the ones used by do_epoch
+        :param bf16: run the forward passes under bfloat16 autocast, as do_epoch will
+        :param num_iters: number of warmup iterations
+        """
+
+        if not self.compiled:
+            return
+        self.train()
+        device_type = next(self.parameters()).device.type
+        for _ in range(num_iters):
+            with bf16_autocast(device_type, bf16):
+                NER_forward_result, RE_forward_result = self.forward(*batch)
+            final_loss = NER_forward_result["loss"] + self.RELossLambda * RE_forward_result["loss"]
+            final_loss.backward()
+        self.zero_grad()
+
+    def score(self, X, Y, C, C_lengths, C_unsort, rstartseqs, rendseqs, rseqs, sents):
         """
         Evaluation through all the shared, NER and RE RNNs.
 
         :param X: encoded sentences
         :param Y: encoded tags
         :param C: encoded characters
-        :param C_lengths: lengths of characters in the words
+        :param C_lengths: lengths of characters in the words, sorted in decreasing order, on the CPU
+        :param C_unsort: indices restoring the original word order of C
         :param rstartseqs: the start indices of the relations for RE
         :param rendseqs: the end indices of relations for RE
         :param rseqs:
@@ -70,19 +157,20 @@ class MTLArchitecture(nn.Module):
         :return:
         """
 
-        shared_representations = self.shared_layers(C, C_lengths, sents)
+        shared_representations = self.shared_layers(C, C_lengths, C_unsort, sents)
         ner_preds, ner_tag_embeddings = self.ner_layers.scorer(shared_representations, Y)
         re_scores = self.re_layers.scorer(shared_representations, ner_tag_embeddings, rstartseqs, rendseqs, rseqs)
         return ner_preds, re_scores
 
-    def forward(self, X, Y, C, C_lengths, rstartseqs, rendseqs, rseqs, sents):
+    def forward(self, X, Y, C, C_lengths, C_unsort, rstartseqs, rendseqs, rseqs, sents):
         """
         Do a single forwawrd pass on the entire architecture - through all the shared, NER and RE RNNs.
 
         :param X: encoded sentences
         :param Y: encoded tags
         :param C: encoded characters
-        :param C_lengths: lengths of characters in the words
+        :param C_lengths: lengths of characters in the words, sorted in decreasing order, on the CPU
+        :param C_unsort: indices restoring the original word order of C
         :param rstartseqs: the start indices of the relations for RE
         :param rendseqs: the end indices of relations for RE
         :param rseqs:
@@ -90,12 +178,12 @@ class MTLArchitecture(nn.Module):
         :return:
         """
 
-        shared_representations = self.shared_layers(C, C_lengths, sents)
+        shared_representations = self.shared_layers(C, C_lengths, C_unsort, sents)
         ner_score, ner_tag_embeddings = self.ner_layers(shared_representations, Y)
         re_score = self.re_layers(shared_representations, ner_tag_embeddings, rstartseqs, rendseqs, rseqs)
         return ner_score, re_score
 
-    def do_epoch(self, epoch_num, train_batches, clip, optim, logger=None, check_interval=200):
+    def do_epoch(self, epoch_num, train_batches, clip, optim, logger=None, check_interval=200, bf16=False):
         """
         Run the forward pass in multiple epochs across training batches.
 
@@ -103,17 +191,20 @@ class MTLArchitecture(nn.Module):
         :param train_batches: the training data batches
         :param optim: the optimiser used for minimising the loss
         :param check_interval: save the results once after this many intervals
+        :param bf16: run the forward pass under bfloat16 autocast, losses are still computed in fp32
         :return:
         """
 
         self.train()
         print("\nTraining...")
+        device_type = next(self.parameters()).device.type
 
         output = {}
-        for batch_num, (X, Y, C, C_lengths, rstartseqs, rendseqs, rseqs, sents) in enumerate(train_batches):
+        for batch_num, (X, Y, C, C_lengths, C_unsort, rstartseqs, rendseqs, rseqs, sents) in enumerate(train_batches):
             # print(batch_num)
             optim.zero_grad()
-            NER_forward_result, RE_forward_result = self.forward(X, Y, C, C_lengths, rstartseqs, rendseqs, rseqs, sents)
+            with bf16_autocast(device_type, bf16):
+                NER_forward_result, RE_forward_result = self.forward(X, Y, C, C_lengths, C_unsort, rstartseqs, rendseqs, rseqs, sents)
             loss_NER, loss_RE = NER_forward_result["loss"], RE_forward_result["loss"]
             final_loss = loss_NER + self.RELossLambda * loss_RE
             final_loss.backward()
@@ -145,9 +236,10 @@ class MTLArchitecture(nn.Module):
 
         return output
 
-    def evaluate(self, eval_batches, logger=None, tag2y=None, rel2y=None):
+    def evaluate(self, eval_batches, logger=None, tag2y=None, rel2y=None, bf16=False):
         self.eval()
         print("Evaluating...")
+        device_type = next(self.parameters()).device.type
         if 'O' in tag2y:
             y2tag = [None for tag in tag2y]
             for tag in tag2y:
@@ -164,10 +256,11 @@ class MTLArchitecture(nn.Module):
         re_fn = 0
         output = dict()
         gold_entities = {}
-        for (X, Y, C, C_lengths, rstartseqs, rendseqs, rseqs, sents) in eval_batches:
+        for (X, Y, C, C_lengths, C_unsort, rstartseqs, rendseqs, rseqs, sents) in eval_batches:
             try:
                 B, T = Y.size()
-                ner_preds, re_scores = self.score(X, Y, C, C_lengths, rstartseqs, rendseqs, rseqs, sents)  # B x T x L
+                with bf16_autocast(device_type, bf16):
+                    ner_preds, re_scores = self.score(X, Y, C, C_lengths, C_unsort, rstartseqs, rendseqs, rseqs, sents)  # B x T x L
 
                 num_preds += B * T
                 num_correct += (ner_preds == Y).sum().item()
@@ -267,7 +360,7 @@ class SharedRNN(nn.Module):
 
     def __init__(self, num_word_types, shared_layer_size, num_char_types, \
                  char_dim, hidden_dim, dropout, num_layers, recurrent_unit="gru", \
-                 device="cpu"):
+                 device="cpu", elmo_cache=None, glove_storage="fp32"):
         """
         :param num_word_types:
         :param shared_layer_size:
@@ -277,17 +370,21 @@ class SharedRNN(nn.Module):
         :param dropout:
         :param num_layers:
         :param recurrent_unit:
+        :param elmo_cache: directory of precomputed ELMO embeddings, ELMO is run on every batch if None
+        :param glove_storage: storage of the Glove table - fp32, int8 (quantized, kept on device) or bf16 (kept on device)
         """
 
         super(SharedRNN, self).__init__()
         self.CharDim = char_dim
         self.Pad_ind = 0
         self.device = device
-        word_dim = self.ELMODim + self.GloveDim + self.CharDim + self.OneHotDim
+        self.elmo_cache = elmo_cache
+        self.glove_storage = glove_storage
+        self.word_dim = word_dim = self.ELMODim + self.GloveDim + 2 * self.CharDim + self.OneHotDim
 
-        # Initialise char-embedding BiRNN
+        # Initialise char-embedding BiRNN, scripted since it runs on every word of every batch
         self.cemb = nn.Embedding(num_char_types, self.CharDim, padding_idx=self.Pad_ind)
-        self.charRNN = CharRNN(self.cemb, 1, recurrent_unit)
+        self.charRNN = torch.jit.script(CharRNN(self.cemb, 1, recurrent_unit))
         self.dropout = nn.Dropout(p=dropout)
 
         if recurrent_unit == "gru":
@@ -295,27 +392,97 @@ class SharedRNN(nn.Module):
         else:
             self.wordRNN = nn.LSTM(word_dim, shared_layer_size, num_layers, bidirectional=True)
 
-    def forward(self, char_encoded, C_lengths, raw_sentences):
+        # Reusable storage for the concatenated word representations and zeros for the initial hidden state of
+        # the word RNN, both grown on demand in forward. They are plain attributes rather than buffers, so they
+        # are (re)allocated on the device of the inputs.
+        self._concat_buf = torch.empty(0)
+        self._h0 = torch.zeros(0)
+
+    def _initial_hidden(self, batch_size, device):
         """
-        Pass the input sentences through the GRU layers.
-        :param X: batch of sentences
-        :return:
+        Return the all-zero initial hidden state of the word RNN, backed by reusable storage that is grown if it
+        is too small and reallocated if it is on another device.
+
+        :param batch_size: the batch dimension of the word RNN input
+        :param device: the device of the word RNN input
+        :return: the initial hidden state, as a (h0, c0) tuple for LSTMs
+        """
+
+        shape = (2 * self.wordRNN.num_layers, batch_size, self.wordRNN.hidden_size)
+        numel = shape[0] * shape[1] * shape[2]
+        if self._h0.numel() < numel or self._h0.device != device:
+            self._h0 = torch.zeros(numel, device=device)
+        h0 = self._h0[:numel].view(shape)
+        return (h0, h0) if isinstance(self.wordRNN, nn.LSTM) else h0
+
+    def _get_concat_buffer(self, batch_size, seq_len, device):
+        """
+        Return a contiguous (batch_size x seq_len x word_dim) view over the concatenation buffer, growing the
+        buffer if it is too small or moving it if it is on another device. The view is detached so that autograd
+        history does not pile up on the buffer across batches.
+
+        :param batch_size: number of sentences in the batch
+        :param seq_len: number of words in each sentence
+        :param device: the device of the word representations
+        :return: uninitialised tensor to write the word representations into
+        """
+
+        numel = batch_size * seq_len * self.word_dim
+        if self._concat_buf.numel() < numel or self._concat_buf.device != device:
+            self._concat_buf = torch.empty(numel, device=device)
+        return self._concat_buf.detach()[:numel].view(batch_size, seq_len, self.word_dim)
+
+    def forward(self, char_encoded, C_lengths, C_unsort, raw_sentences):
+        """
+        Pass the input sentences through the GRU layers. Word inputs are the concatenation of the pretrained ELMo
+        and GloVe vectors, the CharRNN output and the one-hot casing features; there is no trainable word
+        embedding table.
+
+        :param char_encoded: encoded characters of every word in the batch, sorted by decreasing length
+        :param C_lengths: lengths of the words, in decreasing order, on the CPU
+        :param C_unsort: indices restoring the original word order of char_encoded
+        :param raw_sentences: batch of raw non-encoded sentences
+        :return: shared representations (B x T x 2 * shared_layer_size)
         """
 
         batch_size = len(raw_sentences)
-        elmo_embeddings = load_elmo_embeddings(raw_sentences).to(self.device)
-        glove_embeddings = load_glove_embeddings(raw_sentences).to(self.device)
-        char_embeddings = self.charRNN(char_encoded, C_lengths).to(self.device)
+        if self.elmo_cache is not None:
+            elmo_embeddings = load_cached_elmo_embeddings(raw_sentences, self.elmo_cache).to(self.device)
+        else:
+            elmo_embeddings = load_elmo_embeddings(raw_sentences).to(self.device)
+        glove_embeddings = load_glove_embeddings(raw_sentences, self.glove_storage, self.device).to(self.device)
+        char_embeddings = self.charRNN(char_encoded, C_lengths, C_unsort).to(self.device)
         one_hot_embeddings = load_onehot_embeddings(raw_sentences).to(self.device)
+        # The CharRNN ran once over the words of all sentences flattened together (B*T words). Dataset only
+        # batches sentences of the same length, so there are no padding words and a view restores B x T.
         num_words, char_dim = char_embeddings.size()
         char_embeddings = char_embeddings.view(batch_size, num_words // batch_size, char_dim)
-        final_embeddings = torch.cat([elmo_embeddings, glove_embeddings, char_embeddings, one_hot_embeddings], dim=2)
+
+        all_embeddings = (elmo_embeddings, glove_embeddings, char_embeddings, one_hot_embeddings)
+        if is_compiling():
+            # torch.compile turns the in-place writes below into a write-back that reassigns the buffer to a
+            # tensor with autograd history, and Inductor removes the cat anyway.
+            final_embeddings = torch.cat([embeddings.float() for embeddings in all_embeddings], dim=2)
+        else:
+            # Write every embedding into its slice of the reusable buffer instead of allocating a new tensor with
+            # torch.cat on every batch.
+            final_embeddings = self._get_concat_buffer(batch_size, elmo_embeddings.size(1), elmo_embeddings.device)
+            offset = 0
+            for embeddings in all_embeddings:
+                dim = embeddings.size(2)
+                final_embeddings[:, :, offset:offset + dim].copy_(embeddings)
+                offset += dim
 
         # Dropout pre BiRNN
         final_embeddings = self.dropout(final_embeddings)
 
-        # Get the shared layer representations.
-        shared_output, _ = self.wordRNN(final_embeddings)
+        # Get the shared layer representations. Flattening keeps the RNN weights in a single contiguous buffer
+        # (e.g. after load_state_dict or deepcopy) so cuDNN can run the whole stack in one call; it is a no-op
+        # when they already are.
+        self.wordRNN.flatten_parameters()
+        # wordRNN is not batch_first, so its batch dimension is the second one.
+        shared_output, _ = self.wordRNN(final_embeddings, self._initial_hidden(final_embeddings.size(1),
+                                                                                final_embeddings.device))
         return shared_output
 
 
@@ -326,7 +493,7 @@ class NERSpecificRNN(nn.Module):
     """
 
     def __init__(self, shared_layer_size, num_tag_types, hidden_dim, dropout, num_layers, \
-                 init, label_embeddings_size, activation_type="relu", recurrent_unit="gru"):
+                 init, label_embeddings_size, activation_type="relu", recurrent_unit="gru", activation=None):
         """        print(batched[0])
         s
         Initialise.
@@ -339,6 +506,7 @@ class NERSpecificRNN(nn.Module):
         :label_embeddings_size: label embedding size
         :param activation_type: the type of activation function to use
         :param recurrent_unit: the type of recurrent unit to use for biRNN - GRU or LSTM
+        :param activation: an existing activation module to use instead of creating one from activation_type
         """
 
         super(NERSpecificRNN, self).__init__()
@@ -353,15 +521,8 @@ class NERSpecificRNN(nn.Module):
             self.birnn = nn.LSTM(2 * shared_layer_size, shared_layer_size, num_layers, bidirectional=True)
 
         self.dropout = nn.Dropout(p=dropout)
-        self.FFNNe1 = nn.Linear(2 * shared_layer_size, hidden_dim)
-        if activation_type == "relu":
-            self.activation = nn.ReLU()
-        elif activation_type == "tanh":
-            self.activation = nn.Tanh()
-        elif activation_type == "gelu":
-            self.activation = nn.GELU()
-
-        self.FFNNe2 = nn.Linear(hidden_dim, num_tag_types)
+        activation = activation if activation is not None else ACTIVATIONS[activation_type]()
+        self.FFNNe = torch.jit.script(FeedForward(2 * shared_layer_size, hidden_dim, activation, num_tag_types))
         self.loss = CRFLoss(num_tag_types, init)
 
     def forward(self, shared_representations, Y):
@@ -375,9 +536,10 @@ class NERSpecificRNN(nn.Module):
         """
         # Dropout before biRNN
         shared_representations = self.dropout(shared_representations)
+        self.birnn.flatten_parameters()
         ner_representation, _ = self.birnn(shared_representations)
-        scores = self.FFNNe2(self.activation(self.FFNNe1(ner_representation)))
-        loss = self.loss(scores, Y)
+        scores = self.FFNNe(ner_representation)
+        loss = self.loss(scores.float(), Y)  # Keep the CRF loss in fp32 under autocast
         tag_embeddings = self.tag_embeddings(Y)
         return {'loss': loss}, tag_embeddings
 
@@ -389,8 +551,9 @@ class NERSpecificRNN(nn.Module):
         :param Y: the label NER tags for the input sentences
         :return: NER scores
         """
+        self.birnn.flatten_parameters()
         ner_representation, _ = self.birnn(shared_representations)
-        scores = self.FFNNe2(self.activation(self.FFNNe1(ner_representation)))
+        scores = self.FFNNe(ner_representation)
         _, preds = self.loss.decode(scores)  # B x T
         tag_embeddings = self.tag_embeddings(preds)
         # print("Actual Predictions: ", Y)
@@ -406,7 +569,7 @@ class RESpecificRNN(nn.Module):
 
     def __init__(self, shared_layer_size, num_rel_types, hidden_dim, dropout, re_dropout, num_layers, \
                     label_embeddings_size, re_ff1_size, activation_type="relu", \
-                    recurrent_unit="gru", device="cpu"):
+                    recurrent_unit="gru", device="cpu", activation=None):
         """
         Initialise.
 
@@ -418,6 +581,7 @@ class RESpecificRNN(nn.Module):
         :param label_embeddings_size:
         :param activation_type:
         :param recurrent_unit:
+        :param activation: an existing activation module to use instead of creating one from activation_type
         """
 
         super(RESpecificRNN, self).__init__()
@@ -435,14 +599,8 @@ class RESpecificRNN(nn.Module):
         self.dropout = nn.Dropout(p=dropout)
         self.re_dropout = nn.Dropout(p=re_dropout)
 
-        self.FFNNr1 = nn.Linear(final_re_entity_embedding_size, re_ff1_size)
-
-        if activation_type == "relu":
-            self.activation = nn.ReLU()
-        elif activation_type == "tanh":
-            self.activation = nn.Tanh()
-        elif activation_type == "gelu":
-            self.activation = nn.GELU()
+        activation = activation if activation is not None else ACTIVATIONS[activation_type]()
+        self.FFNNr1 = torch.jit.script(FeedForward(final_re_entity_embedding_size, re_ff1_size, activation))
 
         self.FFNNr2 = nn.Linear((2 * re_ff1_size) + 1 + num_rel_types, num_rel_types)
 
@@ -453,8 +611,6 @@ class RESpecificRNN(nn.Module):
         self.M = torch.stack(self.M).to(self.device)
         self.M.requires_grad = True
 
-        self.loss = nn.BCELoss()
-
     def _trim_embeddings(self, embeddings, rstartseqs, rendseqs, rseqs):
         """
         :param embeddings:
@@ -504,9 +660,10 @@ class RESpecificRNN(nn.Module):
         distmult_scores = distmult_scores.squeeze(2)
         distmult_scores = distmult_scores.T  # 1 x num_rel_types
 
-        # Hidden representations of entities
-        first_entity_hidden_repr = self.activation(self.FFNNr1(first_entity_embedding))
-        second_entity_hidden_repr = self.activation(self.FFNNr1(second_entity_embedding))
+        # Hidden representations of entities, both computed with a single matmul
+        entity_embeddings = torch.cat([first_entity_embedding, second_entity_embedding], dim=0)  # (2 x p)
+        entity_hidden_reprs = self.FFNNr1(entity_embeddings)
+        first_entity_hidden_repr, second_entity_hidden_repr = entity_hidden_reprs.split(1, dim=0)
 
         # Cosine distance
         cosine_distance = torch.cosine_similarity(first_entity_hidden_repr, second_entity_hidden_repr)
@@ -547,7 +704,10 @@ class RESpecificRNN(nn.Module):
                         target_RE_Labels_for_entity_pair[:, i] = 1
 
                 # print(predicted_RE_scores_for_entity_pair, target_RE_Labels_for_entity_pair)
-                batch_loss += self.loss(predicted_RE_scores_for_entity_pair, target_RE_Labels_for_entity_pair)
+                # Binary cross entropy is not autocast safe, compute it in fp32
+                with autocast_disabled(predicted_RE_scores_for_entity_pair.device.type):
+                    batch_loss += F.binary_cross_entropy(predicted_RE_scores_for_entity_pair.float(),
+                                                         target_RE_Labels_for_entity_pair)
         return batch_loss
 
     def forward(self, shared_representations, ner_tag_embeddings, rstartseqs, rendseqs, rseqs):
@@ -563,6 +723,7 @@ class RESpecificRNN(nn.Module):
 
         # Pre biRNN dropout
         shared_representations = self.dropout(shared_representations)
+        self.birnn.flatten_parameters()
         re_representation, _ = self.birnn(shared_representations)
         re_representation = torch.cat([re_representation, ner_tag_embeddings], dim=2)
 
@@ -584,6 +745,7 @@ class RESpecificRNN(nn.Module):
         :return:
         """
 
+        self.birnn.flatten_parameters()
         re_representation, _ = self.birnn(shared_representations)
         re_representation = torch.cat([re_representation, ner_tag_embeddings], dim=2)
 
@@ -614,11 +776,39 @@ class RESpecificRNN(nn.Module):
         return batched
 
 
+class FeedForward(nn.Module):
+    """
+    A linear layer followed by an activation and, optionally, a second linear layer. Used for the feed-forward
+    layers of the NER and RE heads, where it is scripted to save the Python dispatch of the small ops.
+    """
+
+    def __init__(self, in_features, hidden_features, activation, out_features=None):
+        """
+        Initialise.
+
+        :param in_features: input size
+        :param hidden_features: output size of the first linear layer
+        :param activation: the activation module applied after the first linear layer
+        :param out_features: output size of the second linear layer, no second layer if None
+        """
+
+        super(FeedForward, self).__init__()
+        self.FF1 = nn.Linear(in_features, hidden_features)
+        self.activation = activation
+        self.FF2 = nn.Linear(hidden_features, out_features) if out_features is not None else nn.Identity()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.FF2(self.activation(self.FF1(x)))
+
+
 class CharRNN(nn.Module):
     """
     Trains character level embeddings via Bidirectional LSTM.
     """
 
+    # Constants let TorchScript compile only the GRU or the LSTM branches of forward.
+    __constants__ = ['num_layers', 'is_lstm']
+
     def __init__(self, cemb, num_layers=1, recurrent_unit="gru"):
         """
         Initialise.
@@ -631,22 +821,65 @@ class CharRNN(nn.Module):
         super(CharRNN, self).__init__()
         self.cemb = cemb
         self.num_layers = num_layers
+        self.is_lstm = recurrent_unit != "gru"
         if recurrent_unit == "gru":
             self.birnn = nn.GRU(cemb.embedding_dim, cemb.embedding_dim, num_layers, bidirectional=True)
         else:
             self.birnn = nn.LSTM(cemb.embedding_dim, cemb.embedding_dim, num_layers, bidirectional=True)
 
-    def forward(self, padded_chars, char_lengths):
+        # Zeros used as the initial hidden state, grown on demand in forward. A plain attribute rather than a
+        # buffer, so it is (re)allocated on the device of the character embeddings.
+        self._h0 = torch.zeros(0)
+
+    def _initial_hidden(self, B: int) -> torch.Tensor:
+        """
+        Return an all-zero (2 * num_layers x B x char_dim) initial hidden state backed by reusable storage,
+        growing the storage if it is too small and reallocating it if it is on another device.
+
+        :param B: number of words
+        :return: the initial hidden state
         """
-        Do a forward pass to learn the character embeddings.
 
-        :param padded_chars: the padded character encodings
-        :param char_lengths: lengths of the words
-        :return: learned character embeddings in the form of biRNN hidden vector
+        numel = 2 * self.num_layers * B * self.birnn.hidden_size
+        weight = self.cemb.weight
+        if self._h0.numel() < numel or not self._h0.device == weight.device:
+            self._h0 = weight.new_zeros([numel])
+        return self._h0[:numel].view(2 * self.num_layers, B, self.birnn.hidden_size)
+
+    def forward(self, padded_chars: torch.Tensor, char_lengths: torch.Tensor,
+                unsort_indices: torch.Tensor) -> torch.Tensor:
         """
-        B = len(char_lengths)
+        Do a forward pass to learn the character embeddings. Kept TorchScript compatible, the module is scripted
+        by SharedRNN.
 
-        packed = pack_padded_sequence(self.cemb(padded_chars), char_lengths,
-                                      batch_first=True, enforce_sorted=False)
-        _, (final_h, _) = self.birnn(packed)
-        return final_h
+        :param padded_chars: the padded character encodings of the words of every sentence in the batch (B*T x
+                             max word length), sorted by decreasing word length
+        :param char_lengths: lengths of the words, in decreasing order, on the CPU
+        :param unsort_indices: indices restoring the original word order
+        :return: learned character embeddings in the form of biRNN hidden vector (B x 2 * char_dim)
+        """
+        B = char_lengths.size(0)
+        h0 = self._initial_hidden(B)
+
+        if int(char_lengths[0]) == int(char_lengths[-1]):
+            # All words have the same length (lengths are sorted), so there is no padding and the fixed-length
+            # path can be used without building a PackedSequence.
+            embedded = self.cemb(padded_chars).transpose(0, 1)
+            if self.is_lstm:
+                _, (final_h, _final_c) = self.birnn(embedded, (h0, h0))
+            else:
+                _, final_h = self.birnn(embedded, h0)
+        else:
+            packed = pack_padded_sequence(self.cemb(padded_chars), char_lengths,
+                                          batch_first=True, enforce_sorted=True)
+            if self.is_lstm:
+                _, (final_h, _final_c) = self.birnn(packed, (h0, h0))
+            else:
+                _, final_h = self.birnn(packed, h0)
+
+        # Concatenate the forward and backward final states of the last layer. Both slices are contiguous, so
+        # this is a single copy with no intermediate transpose.
+        num_dirs = 2
+        final_h = final_h.view(self.num_layers, num_dirs, B, self.birnn.hidden_size)[-1]
+        cembs = torch.cat((final_h[0], final_h[1]), dim=1)
+        return cembs.index_select(0, unsort_indices)
@@ -17,7 +17,8 @@ class Dataset():
                  lower=True,
                  vocab_size=1000000000,
                  pad='<pad>',
-                 unk='<unk>'):
+                 unk='<unk>',
+                 pin_memory=False):
         """
 
         :param data_dir:
@@ -28,6 +29,8 @@ class Dataset():
         :param vocab_size:
         :param pad:
         :param unk:
+        :param pin_memory: keep the batch tensors in pinned CPU memory instead of moving them to device, they are
+                           then expected to be moved by a CUDAPrefetcher
         """
 
         self.data_dir = data_dir
@@ -40,6 +43,7 @@ class Dataset():
         self.UNK = unk
         self.PAD_ind = 0
         self.UNK_ind = 1
+        self.pin_memory = pin_memory
         self.populate_attributes()
 
     def populate_attributes(self):
@@ -80,15 +84,25 @@ class Dataset():
         """
 
         batches = []
+        def place(tensor):
+            return tensor.pin_memory() if self.pin_memory else tensor.to(self.device)
+
         def add_batch(xseqs, yseqs, rstartseqs, rendseqs, rseqs, cseqslist, raw_sentence):
             if not xseqs:
                 return
-            X = torch.stack(xseqs).to(self.device)  # B x T
-            Y = torch.stack(yseqs).to(self.device)  # B x T
+            X = place(torch.stack(xseqs))  # B x T
+            Y = place(torch.stack(yseqs))  # B x T
             flattened_cseqs = [item for sublist in cseqslist for item in sublist]  # List of BT tensors of varying lengths
-            C = pad_sequence(flattened_cseqs, padding_value=self.PAD_ind, batch_first=True).to(self.device)  # BT x T_char
-            C_lens = torch.LongTensor([s.shape[0] for s in flattened_cseqs]).to(self.device)
-            batches.append((X, Y, C, C_lens, rstartseqs, rendseqs, rseqs, raw_sentence))
+            C = pad_sequence(flattened_cseqs, padding_value=self.PAD_ind, batch_first=True)  # BT x T_char
+            C_lens = torch.LongTensor([s.shape[0] for s in flattened_cseqs])
+
+            # Sort the words by length once here so the CharRNN does not have to sort and unsort them on every
+            # pass. C_unsort restores the original word order. C_lens stays on the CPU, where
+            # pack_padded_sequence expects it.
+            C_lens, C_sort = C_lens.sort(descending=True)
+            C = place(C[C_sort])
+            C_unsort = place(C_sort.argsort())
+            batches.append((X, Y, C, C_lens, C_unsort, rstartseqs, rendseqs, rseqs, raw_sentence))
 
         xseqs = []
         yseqs = []
@@ -190,3 +204,53 @@ class Dataset():
         logger.log('Num char types: %d (including PAD/UNK)' %
                    len(self.char2c))
         logger.log('\t%s' % ' '.join(self.char2c.keys()))
+
+
+class CUDAPrefetcher():
+    """
+    Iterates over batches held in pinned CPU memory, copying the next batch to the GPU on a side stream while
+    the current one is being processed.
+    """
+
+    def __init__(self, batches, device):
+        """
+
+        :param batches: batches as built by Dataset with pin_memory=True
+        :param device: the CUDA device to move the batches to
+        """
+
+        self.batches = batches
+        self.device = device
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def preload(self, batch):
+        """
+        Start copying the pinned tensors of a batch to the device on the side stream. Other items, including
+        tensors meant to stay on the CPU, are left as they are.
+
+        :param batch: a batch tuple, or None
+        :return: the batch with its tensors on the device, or None
+        """
+
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            return tuple(item.to(self.device, non_blocking=True) if torch.is_tensor(item) and item.is_pinned()
+                         else item for item in batch)
+
+    def __iter__(self):
+        batches = iter(self.batches)
+        next_batch = self.preload(next(batches, None))
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            for item in batch:
+                if torch.is_tensor(item) and item.is_cuda:
+                    # The tensor was allocated on the side stream but is used on the current one.
+                    item.record_stream(current_stream)
+            next_batch = self.preload(next(batches, None))
+            yield batch
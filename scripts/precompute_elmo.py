@@ -0,0 +1,68 @@
+"""
+Precomputes the ELMO embeddings of every sentence of a dataset so that training can look them up from a
+memory-mapped file instead of running ELMO on every batch.
+
+Writes two files to the output directory:
+    - elmo.bin: all token embeddings, one float16 row of size 1024 per token, sentence after sentence
+    - elmo_index.json: the tokens of every sentence together with the row of its first token
+
+Run from the repository root, e.g. python scripts/precompute_elmo.py --dataset_name conll04
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+from allennlp.modules.elmo import batch_to_ids
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import build_elmo, ELMO_CACHE_FILE, ELMO_CACHE_INDEX_FILE
+
+
+def main(args):
+    path = os.path.join(args.data_dir, args.dataset_name)
+    sentences = []
+    seen = set()
+    for split in ['_train_dev.json', '_dev.json', '_test.json']:
+        with open(os.path.join(path, args.dataset_name + split)) as f:
+            for datapoint in json.load(f):
+                tokens = tuple(datapoint["tokens"])
+                if tokens not in seen:
+                    seen.add(tokens)
+                    sentences.append(list(tokens))
+
+    out_dir = args.out_dir or os.path.join('./data/elmo_cache', args.dataset_name)
+    os.makedirs(out_dir, exist_ok=True)
+    elmo = build_elmo()
+    index = []
+    offset = 0
+
+    with open(os.path.join(out_dir, ELMO_CACHE_FILE), 'wb') as f, torch.no_grad():
+        for start in range(0, len(sentences), args.batch_size):
+            batch = sentences[start:start + args.batch_size]
+            # The biLM carries its LSTM states over between calls. Reset them so every batch is embedded as by
+            # the fresh Elmo that load_elmo_embeddings builds for each batch.
+            elmo._elmo_lstm._elmo_lstm.reset_states()
+            embeddings = elmo(batch_to_ids(batch))['elmo_representations'][-1]
+            for sentence, sentence_embeddings in zip(batch, embeddings):
+                f.write(sentence_embeddings[:len(sentence)].numpy().astype(np.float16).tobytes())
+                index.append({"tokens": sentence, "offset": offset})
+                offset += len(sentence)
+            print('Processed {}/{} sentences'.format(min(start + args.batch_size, len(sentences)), len(sentences)))
+
+    with open(os.path.join(out_dir, ELMO_CACHE_INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_name', default="conll04")
+    parser.add_argument('--data_dir', default="./data/datasets/")
+    parser.add_argument('--out_dir', default=None,
+                        help='directory to write the cache to, defaults to ./data/elmo_cache/<dataset_name>')
+    parser.add_argument('--batch_size', type=int, default=32)
+    args = parser.parse_args()
+    main(args)
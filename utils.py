@@ -1,4 +1,5 @@
 import json
+import functools
 from collections import Counter
 import numpy as np
 from allennlp.modules.elmo import Elmo, batch_to_ids
@@ -11,6 +12,10 @@ import torch.nn as nn
 conll_entities = set()
 conll_relations = set()
 
+ELMO_CACHE_FILE = "elmo.bin"
+ELMO_CACHE_INDEX_FILE = "elmo_index.json"
+ELMO_DIM = 1024
+
 def get_init_weights(init_value):
     """
 
@@ -115,14 +120,12 @@ def load_vertical_tagged_data(path, sort_by_length=True):
 
     return wordseqs, tagseqs, relseqs, charseqslist, wordcounter, tagcounter, relcounter, charcounter
 
-def load_elmo_embeddings(sentences, num_output_representations=1, dropout=0, mode="single"):
+def build_elmo(num_output_representations=1, dropout=0):
     """
-    Converts each word of the sentences to their respective ELMO embeddings.
+    Builds the pretrained ELMO model, using the locally saved weights if they are available.
 
-    :param sentences:
     :param num_output_representations:
     :param dropout:
-    :param mode:
     :return:
     """
 
@@ -132,7 +135,20 @@ def load_elmo_embeddings(sentences, num_output_representations=1, dropout=0, mod
     else:
         weight_file = "https://s3-us-west-2.amazonaws.com/allennlp/models/elmo/2x4096_512_2048cnn_2xhighway_5.5B/elmo_2x4096_512_2048cnn_2xhighway_5.5B_weights.hdf5"
 
-    elmo = Elmo(options_file, weight_file, num_output_representations=num_output_representations, dropout=dropout)
+    return Elmo(options_file, weight_file, num_output_representations=num_output_representations, dropout=dropout)
+
+def load_elmo_embeddings(sentences, num_output_representations=1, dropout=0, mode="single"):
+    """
+    Converts each word of the sentences to their respective ELMO embeddings.
+
+    :param sentences:
+    :param num_output_representations:
+    :param dropout:
+    :param mode:
+    :return:
+    """
+
+    elmo = build_elmo(num_output_representations, dropout)
 
     # Converts a batch of tokenized sentences to a tensor representing the sentences with encoded
     # characters (len(batch), max sentence length, max word length).
@@ -157,14 +173,108 @@ def load_elmo_embeddings(sentences, num_output_representations=1, dropout=0, mod
             embeddings = torch.matmul(embeddings, vars).view(batch_size, -1, embed_dim)
             return embeddings
 
-def load_glove_embeddings(sentences):
+@functools.lru_cache(maxsize=None)
+def load_elmo_cache(cache_dir):
+    """
+    Opens the ELMO embeddings precomputed by scripts/precompute_elmo.py. The embeddings are memory-mapped rather
+    than read into memory, and the result is memoised so the files are only opened once per cache directory.
+
+    :param cache_dir: directory holding the cache files
+    :return: (N_tokens x ELMO_DIM float16 memmap, dict mapping a sentence's token tuple to its first row)
+    """
+
+    embeddings = np.memmap(os.path.join(cache_dir, ELMO_CACHE_FILE), dtype=np.float16, mode='r')
+    embeddings = embeddings.reshape(-1, ELMO_DIM)
+    with open(os.path.join(cache_dir, ELMO_CACHE_INDEX_FILE)) as f:
+        offsets = {tuple(entry["tokens"]): entry["offset"] for entry in json.load(f)}
+    return embeddings, offsets
+
+def load_cached_elmo_embeddings(sentences, cache_dir):
+    """
+    Looks up the precomputed ELMO embeddings of the sentences, a drop-in replacement for load_elmo_embeddings
+    in "single" mode that returns float16 embeddings.
+
+    :param sentences: batch of tokenized sentences
+    :param cache_dir: directory holding the cache files
+    :return: batch_size x max_len x ELMO_DIM float16 tensor
+    """
+
+    embeddings, offsets = load_elmo_cache(cache_dir)
+    max_len = max([len(sentence) for sentence in sentences])
+    final_sentences = np.zeros((len(sentences), max_len, ELMO_DIM), dtype=np.float16)
+    for i, sentence in enumerate(sentences):
+        offset = offsets[tuple(sentence)]
+        final_sentences[i, :len(sentence)] = embeddings[offset:offset + len(sentence)]
+    return torch.from_numpy(final_sentences)
+
+@functools.lru_cache(maxsize=None)
+def load_quantized_glove(device):
+    """
+    Loads the Glove vectors and quantizes them to int8 with one float16 scale per row, which cuts the memory of
+    the table by 4x. The table and scales are kept on the device, so lookups gather int8 rows there and only
+    word indices have to be sent over per batch. An all-zero row is appended at the end for unknown words and
+    padding. The result is memoised per device.
+
+    :param device: the device to keep the table on
+    :return: (token to row dict, N x 300 int8 vectors, N float16 scales)
+    """
+
+    glove_vectors = Vectors('glove.6B.300d.txt', './pretrained_weights/')
+    vectors = torch.cat([glove_vectors.vectors, torch.zeros(1, glove_vectors.dim)], dim=0)
+    scale = vectors.abs().max(dim=1)[0] / 127
+    quantized = (vectors / scale.clamp(min=1e-12).unsqueeze(1)).round().clamp(-128, 127).to(torch.int8)
+    return glove_vectors.stoi, quantized.to(device), scale.to(device=device, dtype=torch.float16)
+
+@functools.lru_cache(maxsize=None)
+def load_bf16_glove(device):
+    """
+    Loads the Glove vectors into a bfloat16 table kept on the device, so only word indices have to be sent over
+    per batch. An all-zero row is appended at the end for unknown words and padding. The result is memoised per
+    device.
+
+    :param device: the device to keep the table on
+    :return: (token to row dict, N x 300 bfloat16 vectors)
+    """
+
+    glove_vectors = Vectors('glove.6B.300d.txt', './pretrained_weights/')
+    vectors = torch.cat([glove_vectors.vectors, torch.zeros(1, glove_vectors.dim)], dim=0)
+    return glove_vectors.stoi, vectors.to(device=device, dtype=torch.bfloat16)
+
+def get_glove_ids(sentences, stoi):
+    """
+    Converts the words of the sentences to rows of a Glove table built by load_quantized_glove or load_bf16_glove.
+    Unknown words and padding map to the all-zero last row.
+
+    :param sentences:
+    :param stoi: token to row dict of the Glove vectors
+    :return: batch_size x max_len LongTensor
+    """
+
+    unk = len(stoi)
+    max_len = max([len(sentence) for sentence in sentences])
+    return torch.LongTensor([[stoi.get(word, unk) for word in sentence] + [unk] * (max_len - len(sentence))
+                             for sentence in sentences])
+
+def load_glove_embeddings(sentences, storage="fp32", device="cpu"):
     """
     Converts each word of the sentences to the respective Glove embeddings.
 
     :param sentences
+    :param storage: "fp32" to look the words up in the Glove vectors, "int8" to use the quantized table kept on
+                    device (returns float16 embeddings already on device) or "bf16" to use the bfloat16 table
+                    kept on device (returns bfloat16 embeddings already on device)
+    :param device: the device of the int8 and bfloat16 tables
     return:
     """
 
+    if storage == "int8":
+        stoi, vectors, scale = load_quantized_glove(torch.device(device))
+        ids = get_glove_ids(sentences, stoi).to(vectors.device)
+        return vectors[ids].to(torch.float16) * scale[ids].unsqueeze(-1)
+    elif storage == "bf16":
+        stoi, vectors = load_bf16_glove(torch.device(device))
+        return vectors[get_glove_ids(sentences, stoi).to(vectors.device)]
+
     # Load the glove vectors saved locally.
     glove_vectors = Vectors('glove.6B.300d.txt', './pretrained_weights/')
 